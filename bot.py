@@ -1,12 +1,29 @@
 import os
+import re
+import logging
+import json
+import math
+import hashlib
+import operator
+import asyncio
 import time
+import signal
+import orjson
 import requests
 import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
-from queue import Queue
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+from queue import Full, Queue
+from collections import defaultdict, deque, OrderedDict
 from mattermostdriver import Driver
 
+# Logging setup; set LOG_LEVEL=DEBUG to see detailed processing output
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(asctime)s %(levelname)s %(message)s")
+log = logging.getLogger("bot")
+
 # Mattermost settings
 MATTERMOST_URL = os.getenv("MATTERMOST_URL")
 
@@ -25,240 +42,792 @@ TEAM_NAME = os.getenv("TEAM_NAME")
 OLLAMA_API_URL = os.getenv("OLLAMA_API_URL")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL")
 
+# Connect / read timeouts (seconds) for Ollama requests
+OLLAMA_TIMEOUT = (5, 120)
+
+# System prompt sent at the start of every conversation. Keep it free of anything that changes
+# between requests (timestamps, names, ...) so Ollama can reuse its prompt cache for it.
+SYSTEM_PROMPT = os.getenv("OLLAMA_SYSTEM_PROMPT", "You are a helpful assistant answering questions in a Mattermost chat.")
+SYSTEM_PROMPT_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
 # Enable or disable context tracking
 ENABLE_CONTEXT_TRACKING = True  # Set to True to enable context tracking
 
+# Context window of the model in tokens, used to decide when a conversation needs compacting
+CONTEXT_TOKEN_LIMIT = int(os.getenv("OLLAMA_CONTEXT_LIMIT", "4096"))
+# Compact a conversation once it uses more than this fraction of the context window
+COMPACTION_THRESHOLD = 0.7
+# Messages at the start and end of a conversation that are always kept verbatim when compacting
+HISTORY_HEAD_MESSAGES = 2
+HISTORY_TAIL_MESSAGES = 6
+
+# Minimum time in seconds between edits of a post while its answer is streamed in
+STREAM_UPDATE_INTERVAL = 0.5
+
+# Enable or disable reusing answers for prompts that are similar (not just identical) to earlier ones
+ENABLE_SEMANTIC_CACHE = False  # Costs one embeddings request per prompt without context
+
+# Response cache settings
+RESPONSE_CACHE_SIZE = 512  # Exact (model, context, prompt) matches kept
+SEMANTIC_CACHE_SIZE = 64  # Prompt embeddings kept for similarity lookups
+SEMANTIC_CACHE_THRESHOLD = 0.92  # Minimum cosine similarity for a semantic cache hit
+SEMANTIC_CACHE_TTL_SECONDS = 300.0
+
 # Initialize Mattermost driver with the provided settings (disable debug mode)
 driver = Driver({
     "url": MATTERMOST_URL,
     "token": BOT_TOKEN,
     "scheme": "https",
     "port": 443,
-    "debug": False  # Disable debug mode to reduce shell output
+    "debug": False,  # Disable debug mode to reduce shell output
+    "keepalive": True  # Reconnect the websocket if the connection drops
 })
 
-# Debug messages flag
-debug_messages = True  # Set to False if you want to suppress debug output
+# Shared HTTP session for Ollama so the connection is kept alive between requests.
+# Request bodies are serialized with orjson, so the JSON content type is set on the session.
+_ollama_session = requests.Session()
+_ollama_session.headers.update({"Content-Type": "application/json"})
+_ollama_session.mount(
+    f"{urlsplit(OLLAMA_API_URL).scheme}://" if OLLAMA_API_URL else "http://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        # Only retry failed connections and gateway errors; a read timeout means Ollama may still be
+        # generating, so resending would only queue duplicate work on the GPU
+        max_retries=Retry(
+            total=2,
+            connect=2,
+            read=0,
+            other=0,
+            status=2,
+            backoff_factor=0.2,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=None,  # Also retry POSTs on gateway errors
+            raise_on_status=False,
+        ),
+    ),
+)
 
 # Dictionary to store the timestamp of the last processed message for each channel
-last_processed_timestamp = {}
-# Dictionary to track the last polling time for each channel
+last_processed_timestamp = defaultdict(float)
+# Dictionary to track the last seen post time for each channel (used to catch up after reconnects)
 last_poll_time = {}
 
-# Message queue to hold new messages for processing
-message_queue = Queue()
-
-# User context dictionary to store conversation context for each user
-# Structure: { user_id: (context, last_interaction_time) }
-user_context = {}  # Maps user_id to (context, last_interaction_time)
+# Thread pool used to fetch channel posts in parallel during catch-up
+_poll_pool = ThreadPoolExecutor(max_workers=8)
+# Single thread running the websocket handler's blocking work, one event at a time and in arrival order.
+# The driver cancels the handler's await when its receive timeout fires, but the work queued here still
+# runs in order, so a later post is never queued ahead of an earlier one.
+_ws_executor = ThreadPoolExecutor(max_workers=1)
+
+# Thread pool used to answer messages; Ollama calls for different users run concurrently
+PROCESSOR_WORKERS = 4
+_processor_pool = ThreadPoolExecutor(max_workers=PROCESSOR_WORKERS)
+# One slot per worker. The dispatcher takes a slot before it takes a message off the queue, so messages
+# wait in the bounded message_queue rather than in the executor's own, unbounded, work queue.
+_worker_slots = threading.BoundedSemaphore(PROCESSOR_WORKERS)
+
+# Message queue to hold new messages for processing. It is bounded so a burst of messages (or a
+# stalled Ollama) cannot grow it without limit; messages that do not fit are dropped.
+MESSAGE_QUEUE_SIZE = 256
+message_queue = Queue(maxsize=MESSAGE_QUEUE_SIZE)
+
+# Set when the bot is shutting down
+stop_evt = threading.Event()
+
+# User context dictionary to store the conversation history for each user, least recently used first
+# Structure: { user_id: history } where history is a tuple of {"role", "content"} chat messages
+user_context = OrderedDict()  # Maps user_id to history
+# Maximum number of users to keep context for; the least recently active are dropped first
+MAX_USERS = 256
+# Lock guarding the ordering / eviction of user_context
+_context_lock = threading.Lock()
+# Messages waiting behind the one currently being answered, per user: { user_id: deque of items }.
+# A user has an entry only while one of their messages is in progress, so they are answered in order.
+_user_chains = {}
+# Lock guarding _user_chains
+_chains_lock = threading.Lock()
+# Most messages a user can have waiting behind the one being answered; further ones are dropped.
+# Only users with a drain task running have a chain, so at most PROCESSOR_WORKERS chains exist at once.
+MAX_PENDING_PER_USER = 16
+# Lock guarding last_processed_timestamp, which is written by several workers
+_timestamp_lock = threading.Lock()
+
+# Cache of Ollama answers: { (model, history_hash, prompt): (response, history) }, least recently used first
+_response_cache = OrderedDict()
+# Semantic cache entries: [(created_at, embedding, embedding_norm, response)]
+_semantic_cache = []
+# Lock guarding both response caches
+_response_cache_lock = threading.Lock()
+
+# Function to get the current wall-clock time in milliseconds, the unit Mattermost uses for timestamps
+def _now_ms():
+    return time.time_ns() // 1_000_000
 
 # Store the bot's boot time to avoid responding to messages before it started
-boot_time = int(datetime.now().timestamp() * 1000)  # Boot time in milliseconds
-
-# Context expiration duration (4 minutes)
-CONTEXT_EXPIRATION_DURATION = timedelta(minutes=4)
+boot_time = _now_ms()  # Boot time in milliseconds
 
 # Function to post a message to a Mattermost channel
 def post_message_to_mattermost(channel_id, message):
-    driver.posts.create_post({
+    return driver.posts.create_post({
         "channel_id": channel_id,
         "message": message
     })
 
-# Function to send a prompt to the Ollama API and get the response
-def get_ollama_response(prompt, context=None):
-    headers = {
-        "Content-Type": "application/json"
-    }
-    # Construct the request data
+# Function to replace the text of a message the bot already posted
+def update_message_on_mattermost(post_id, message):
+    driver.posts.patch_post(post_id, {
+        "message": message
+    })
+
+# Function to build a short, stable key for a conversation history
+def _context_hash(context):
+    return hashlib.blake2b(orjson.dumps(list(context)), digest_size=16).hexdigest()
+
+# Function to get the embedding vector of a prompt from the Ollama API (used by the semantic cache)
+def get_ollama_embedding(prompt):
+    try:
+        response = _ollama_session.post(
+            f"{OLLAMA_API_URL}/api/embeddings",
+            data=orjson.dumps({"model": OLLAMA_MODEL, "prompt": prompt}),
+            timeout=OLLAMA_TIMEOUT,
+        )
+        if response.status_code == 200:
+            return orjson.loads(response.content).get("embedding")
+        log.error("Ollama returned status code %s for embeddings", response.status_code)
+    except Exception as e:
+        log.error("Error getting embedding from Ollama: %s", e)
+    return None
+
+# Function to find a cached response for a prompt similar enough to the given embedding
+def _semantic_cache_lookup(embedding):
+    norm = math.sqrt(sum(x * x for x in embedding)) or 1.0
+    now = time.monotonic()
+    with _response_cache_lock:
+        # Drop expired entries first
+        _semantic_cache[:] = [entry for entry in _semantic_cache if now - entry[0] <= SEMANTIC_CACHE_TTL_SECONDS]
+        for _, cached_embedding, cached_norm, reply in _semantic_cache:
+            similarity = sum(map(operator.mul, embedding, cached_embedding)) / (norm * cached_norm)
+            if similarity >= SEMANTIC_CACHE_THRESHOLD:
+                return reply
+    return None
+
+# Function to remember a response under the embedding of its prompt
+def _semantic_cache_store(embedding, reply):
+    norm = math.sqrt(sum(x * x for x in embedding)) or 1.0
+    with _response_cache_lock:
+        _semantic_cache.append((time.monotonic(), embedding, norm, reply))
+        del _semantic_cache[:-SEMANTIC_CACHE_SIZE]
+
+# Function to stream an answer to the given chat messages from the Ollama API
+# Returns (reply, None) on success and (None, error message for the user) on failure. While the answer
+# is being generated, on_partial (if given) is called with the text so far, at most every
+# STREAM_UPDATE_INTERVAL seconds.
+def _stream_ollama_chat(messages, on_partial=None):
+    # The system prompt and earlier turns form a byte-identical prefix across requests,
+    # only the new user message at the end changes.
     data = {
         "model": OLLAMA_MODEL,  # Use the dynamic model variable
-        "prompt": prompt,
-        "stream": False  # Ensure streaming is disabled
+        "messages": [SYSTEM_PROMPT_MESSAGE, *messages],
+        "stream": True  # Receive the answer token by token as it is generated
     }
 
-    # Only send context if ENABLE_CONTEXT_TRACKING is True and context is provided
-    if ENABLE_CONTEXT_TRACKING and context:
-        data["context"] = context
-
     # Debug output: Show what is being sent to Ollama API
-    if debug_messages:
-        print(f"[DEBUG] Sending to Ollama: {data}")
+    log.debug("Sending to Ollama: %s", data)
 
     try:
-        response = requests.post(f"{OLLAMA_API_URL}/api/generate", json=data, headers=headers)
+        # Closing the response (after reading it to the end) hands its connection back to the session's pool
+        with _ollama_session.post(f"{OLLAMA_API_URL}/api/chat", data=orjson.dumps(data), timeout=OLLAMA_TIMEOUT, stream=True) as response:
+            if response.status_code != 200:
+                log.error("Ollama returned status code %s", response.status_code)
+                log.debug("Response Content: %s", response.text)
+                return None, f"Error: Ollama returned status code {response.status_code}"
+
+            # Each line of the response is a JSON object carrying the next piece of the answer
+            chunks = []
+            done = False
+            last_update = 0.0
+            for line in response.iter_lines():
+                # Keep reading past the "done" line until the stream ends, so the connection can be reused
+                if done or not line:
+                    continue
+                ollama_response = orjson.loads(line)
+                if "error" in ollama_response:
+                    log.error("Ollama reported an error while generating: %s", ollama_response["error"])
+                    return None, "Error: Ollama failed while generating a response."
+                chunks.append(ollama_response.get("message", {}).get("content", ""))
+                done = ollama_response.get("done", False)
+                now = time.monotonic()
+                if on_partial and not done and now - last_update >= STREAM_UPDATE_INTERVAL:
+                    on_partial("".join(chunks))
+                    last_update = now
+
+            if not done:
+                # The stream was cut off, so the answer is incomplete (and must not be cached)
+                log.error("Ollama's response ended before the answer was done")
+                return None, "Error: Ollama's response ended unexpectedly."
+            return "".join(chunks) or "No response from Ollama", None
+    except Exception as e:
+        log.error("Error communicating with Ollama: %s", e)
+        return None, "Error: Unable to get a response from Ollama."
+
+# Function to look up an answer in the exact response cache
+def _response_cache_get(cache_key):
+    with _response_cache_lock:
+        if cache_key in _response_cache:
+            _response_cache.move_to_end(cache_key)
+            return _response_cache[cache_key]
+    return None
+
+# Function to remember a successful answer in the exact response cache
+def _response_cache_put(cache_key, result):
+    with _response_cache_lock:
+        _response_cache[cache_key] = result
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+# Function to send a prompt to the Ollama API without any conversation history
+# Returns the response text and this exchange as the conversation history
+def _get_ollama_response_stateless(prompt, context=(), on_partial=None):
+    cache_key = (OLLAMA_MODEL, "", prompt)
+    if cached := _response_cache_get(cache_key):
+        log.debug("Response cache hit for: %s", prompt)
+        return cached
+
+    user_message = {"role": "user", "content": prompt}
+
+    # Similar prompts can reuse an earlier answer, since without context the prompt is all that matters
+    embedding = None
+    if ENABLE_SEMANTIC_CACHE:
+        embedding = get_ollama_embedding(prompt)
+        if embedding and (reply := _semantic_cache_lookup(embedding)):
+            log.debug("Semantic cache hit for: %s", prompt)
+            return reply, (user_message, {"role": "assistant", "content": reply})
+
+    reply, error = _stream_ollama_chat((user_message,), on_partial)
+    if reply is None:
+        return error, ()
+
+    # Only successful responses are cached
+    result = reply, (user_message, {"role": "assistant", "content": reply})
+    _response_cache_put(cache_key, result)
+    if embedding:
+        _semantic_cache_store(embedding, reply)
+    return result
+
+# Function to send a prompt (following the given conversation history) to the Ollama API and get the response
+# Returns the response text and the conversation history including this exchange
+def _get_ollama_response_with_context(prompt, context=(), on_partial=None):
+    # The first message of a conversation has nothing to follow, so it is answered (and cached) like a stateless one
+    if not context:
+        return _get_ollama_response_stateless(prompt, (), on_partial)
+
+    # Identical prompts in an identical conversation state get the cached answer
+    cache_key = (OLLAMA_MODEL, _context_hash(context), prompt)
+    if cached := _response_cache_get(cache_key):
+        log.debug("Response cache hit for: %s", prompt)
+        return cached
+
+    user_message = {"role": "user", "content": prompt}
+    reply, error = _stream_ollama_chat((*context, user_message), on_partial)
+    if reply is None:
+        # Keep the conversation as it was so the failed exchange is not remembered
+        return error, context
+
+    # Only successful responses are cached
+    result = reply, (*context, user_message, {"role": "assistant", "content": reply})
+    _response_cache_put(cache_key, result)
+    return result
+
+# ENABLE_CONTEXT_TRACKING is fixed at startup, so pick the matching implementation once here
+# instead of checking the flag on every message
+if ENABLE_CONTEXT_TRACKING:
+    get_ollama_response = _get_ollama_response_with_context
+else:
+    get_ollama_response = _get_ollama_response_stateless
+
+# Function to roughly estimate the number of tokens in a list of chat messages (~4 characters per token)
+def estimate_tokens(messages):
+    return sum(len(message["content"]) // 4 for message in messages)
+
+# Function to ask the Ollama API for a short summary of part of a conversation
+def summarize_messages(messages):
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    data = {
+        "model": OLLAMA_MODEL,
+        "messages": [
+            {"role": "system", "content": "Summarize the following conversation in a few sentences. Keep names, facts, decisions and open questions."},
+            {"role": "user", "content": transcript},
+        ],
+        "stream": False
+    }
+    try:
+        response = _ollama_session.post(f"{OLLAMA_API_URL}/api/chat", data=orjson.dumps(data), timeout=OLLAMA_TIMEOUT)
         if response.status_code == 200:
-            # Parse the response from Ollama
-            ollama_response = response.json()
-            return ollama_response.get("response", "No response from Ollama"), ollama_response.get("context", "")
-        else:
-            print(f"Error: Ollama returned status code {response.status_code}")
-            if debug_messages:
-                print(f"[DEBUG] Response Content: {response.text}")
-            return f"Error: Ollama returned status code {response.status_code}", ""
+            return orjson.loads(response.content).get("message", {}).get("content")
+        log.error("Ollama returned status code %s while summarizing", response.status_code)
     except Exception as e:
-        print(f"Error communicating with Ollama: {e}")
-        return "Error: Unable to get a response from Ollama.", ""
-
-# Worker function to process messages from the queue
-def message_processor():
-    while True:
+        log.error("Error summarizing conversation with Ollama: %s", e)
+    return None
+
+# Prefix of the system message that replaces the summarized middle of a conversation
+SUMMARY_PREFIX = "Summary so far: "
+
+# Function to keep a conversation within the context window: once it grows past the threshold,
+# the middle of the conversation is replaced by a summary while its head and tail stay verbatim
+def compact_history(history):
+    tokens = estimate_tokens((SYSTEM_PROMPT_MESSAGE, *history))
+    if tokens <= COMPACTION_THRESHOLD * CONTEXT_TOKEN_LIMIT:
+        return history
+
+    # Split between exchanges, so the head ends with an answer and the tail starts with a question
+    head_end = HISTORY_HEAD_MESSAGES
+    while head_end < len(history) and history[head_end - 1]["role"] == "user":
+        head_end += 1
+    tail_start = max(len(history) - HISTORY_TAIL_MESSAGES, head_end)
+    while tail_start < len(history) and history[tail_start]["role"] != "user":
+        tail_start += 1
+    head = history[:head_end]
+    middle = history[head_end:tail_start]
+    tail = history[tail_start:]
+    if not any(message["role"] != "system" for message in middle):
+        # Only a few, long messages (besides an earlier summary): nothing new to summarize, so make them fit directly
+        return trim_history(history)
+
+    log.debug("Compacting conversation of ~%d tokens (%d messages to summarize).", tokens, len(middle))
+
+    summary = summarize_messages(middle)
+    if not summary:
+        # Without a summary, drop the middle rather than let the conversation overflow the context window
+        return trim_history((*head, *tail))
+    # The head and tail may be over the threshold on their own; trim them so the next message
+    # does not summarize the summary all over again
+    return trim_history((*head, {"role": "system", "content": SUMMARY_PREFIX + summary}, *tail))
+
+# Function to bring a conversation under the compaction threshold without asking Ollama: the oldest
+# exchanges after the head (and its summary, if any) are dropped first, keeping the latest one, then long
+# messages are truncated
+def trim_history(history):
+    budget = COMPACTION_THRESHOLD * CONTEXT_TOKEN_LIMIT
+    history = list(history)
+    keep = HISTORY_HEAD_MESSAGES
+    if len(history) > keep and history[keep]["role"] == "system" and history[keep]["content"].startswith(SUMMARY_PREFIX):
+        keep += 1
+    while len(history) > keep + 2 and estimate_tokens((SYSTEM_PROMPT_MESSAGE, *history)) > budget:
+        # Drop a question together with its answer, so the remaining messages still alternate
+        if history[keep]["role"] == "user" and history[keep + 1]["role"] == "assistant":
+            del history[keep:keep + 2]
+        else:
+            del history[keep]
+    if estimate_tokens((SYSTEM_PROMPT_MESSAGE, *history)) > budget:
+        # Give every remaining message an equal share of what the system prompt leaves over
+        max_chars = max(int(budget - estimate_tokens((SYSTEM_PROMPT_MESSAGE,))) // len(history), 1) * 4
+        history = [
+            {**message, "content": message["content"][:max_chars]} if len(message["content"]) > max_chars else message
+            for message in history
+        ]
+    return tuple(history)
+
+# Function to ask Ollama for an answer and post it to the channel, streaming it in as it is generated
+# Returns the answer and the conversation history including this exchange
+def _answer_message(channel_id, message_text, context):
+    # The first partial answer creates the post, later ones edit it
+    reply_post_id = None
+
+    def show_partial(text):
+        nonlocal reply_post_id
         try:
-            # Wait for a new message to be added to the queue
-            channel_id, message_text, sender_username, message_time = message_queue.get()
-
-            # Update user context and check for expiration
-            user_id = sender_username  # Assuming sender_username is the user's ID
-            current_time = datetime.now()
-
-            # Initialize or update context for the user
-            if user_id not in user_context:
-                user_context[user_id] = ("", current_time)  # Start with empty context for the first interaction
-
-            # Expire context if necessary
-            context, last_interaction_time = user_context[user_id]
-            if ENABLE_CONTEXT_TRACKING and current_time - last_interaction_time > CONTEXT_EXPIRATION_DURATION:
-                context = ""  # Reset context if expired
-                if debug_messages:
-                    print(f"[DEBUG] User context for {user_id} expired.")
-
-            # Only include context if context tracking is enabled
-            if ENABLE_CONTEXT_TRACKING and context:
-                bot_response, new_context = get_ollama_response(message_text, context)
+            if reply_post_id is None:
+                reply_post_id = post_message_to_mattermost(channel_id, text + " …")["id"]
             else:
-                bot_response, new_context = get_ollama_response(message_text)
+                update_message_on_mattermost(reply_post_id, text + " …")
+        except Exception as e:
+            log.error("Error posting partial response: %s", e)
+
+    bot_response, new_context = get_ollama_response(message_text, context, show_partial)
+    log.debug("Ollama response: %s", bot_response)
+
+    # Post the response back to the channel (or finish the post streamed so far)
+    if reply_post_id is None:
+        post_message_to_mattermost(channel_id, bot_response)
+    else:
+        update_message_on_mattermost(reply_post_id, bot_response)
+    return bot_response, new_context
+
+# Function to record that a channel's messages up to message_time have been answered
+def _mark_processed(channel_id, message_time):
+    # Workers can finish out of order, so never move the timestamp backwards
+    with _timestamp_lock:
+        last_processed_timestamp[channel_id] = max(last_processed_timestamp[channel_id], message_time)
+    log.debug("Updated last_processed_timestamp for channel %s to %s after processing.", channel_id, message_time)
+
+# Function to process a single queued message, continuing the sender's conversation
+def _handle_message_with_ctx(item):
+    try:
+        channel_id, message_text, sender_username, message_time = item
+
+        # Look up the user's conversation
+        user_id = sender_username  # Assuming sender_username is the user's ID
 
-            if debug_messages:
-                print(f"Ollama response: {bot_response}")
+        # Start with an empty conversation for the first interaction. Only one message per user is
+        # handled at a time (see _dispatch_with_ctx), so nothing else touches this user's context meanwhile.
+        context = user_context.get(user_id, ())
 
-            # If context tracking is enabled, update the user's context
-            if ENABLE_CONTEXT_TRACKING:
-                user_context[user_id] = (new_context, current_time)
+        _, new_context = _answer_message(channel_id, message_text, context)
+        log.debug("Bot response sent to %s", sender_username)
+
+        # Update the user's context (compacting it after the answer has been posted, so the
+        # summary request does not delay the reply)
+        new_context = compact_history(new_context)
+        with _context_lock:
+            user_context[user_id] = new_context
+            user_context.move_to_end(user_id)
+            while len(user_context) > MAX_USERS:
+                user_context.popitem(last=False)
+
+        # Update the last processed timestamp for this channel **after processing**
+        _mark_processed(channel_id, message_time)
+
+    except Exception as e:
+        log.error("Error processing message: %s", e)
+    finally:
+        # Mark the message as processed
+        message_queue.task_done()
+
+# Function to process a single queued message on its own. Without a conversation to keep
+# consistent, messages from the same user do not need to wait for each other.
+def _handle_message_stateless(item):
+    try:
+        channel_id, message_text, sender_username, message_time = item
 
-            # Post the response back to the channel
-            post_message_to_mattermost(channel_id, bot_response)
-            if debug_messages:
-                print(f"Bot response sent to {sender_username}")
+        _answer_message(channel_id, message_text, ())
+        log.debug("Bot response sent to %s", sender_username)
 
-            # Update the last processed timestamp for this channel **after processing**
-            last_processed_timestamp[channel_id] = message_time
-            if debug_messages:
-                print(f"[DEBUG] Updated last_processed_timestamp for channel {channel_id} to {message_time} after processing.")
+        # Update the last processed timestamp for this channel **after processing**
+        _mark_processed(channel_id, message_time)
 
-            # Mark the message as processed
+    except Exception as e:
+        log.error("Error processing message: %s", e)
+    finally:
+        # Mark the message as processed and free the worker for the next one
+        message_queue.task_done()
+        _worker_slots.release()
+
+# Function to answer a user's messages one after another, oldest first, until none are waiting
+def _drain_user_messages(user_id, item):
+    try:
+        while item is not None:
+            _handle_message_with_ctx(item)
+            with _chains_lock:
+                chain = _user_chains[user_id]
+                if chain:
+                    item = chain.popleft()
+                else:
+                    # Nothing left for this user: drop the entry so the next message starts a new chain
+                    del _user_chains[user_id]
+                    item = None
+    finally:
+        # Free the worker held for this user's chain
+        _worker_slots.release()
+
+# Function to hand a message to the processor pool, keeping each user's messages in order. A message
+# from a user who is already being answered waits in that user's chain instead of occupying a worker.
+def _dispatch_with_ctx(item):
+    user_id = item[2]  # sender_username
+    with _chains_lock:
+        if user_id in _user_chains:
+            chain = _user_chains[user_id]
+            if len(chain) < MAX_PENDING_PER_USER:
+                chain.append(item)
+            else:
+                log.warning("Too many messages waiting for %s, dropping message in channel %s.", user_id, item[0])
+                message_queue.task_done()
+            # The chain's drain task already holds a worker, so this message does not need one
+            _worker_slots.release()
+            return
+        _user_chains[user_id] = deque()
+    _processor_pool.submit(_drain_user_messages, user_id, item)
+
+# Function to hand a message to the processor pool on its own
+def _dispatch_stateless(item):
+    _processor_pool.submit(_handle_message_stateless, item)
+
+# Pick the dispatch strategy matching ENABLE_CONTEXT_TRACKING once, at startup
+if ENABLE_CONTEXT_TRACKING:
+    _dispatch_message = _dispatch_with_ctx
+else:
+    _dispatch_message = _dispatch_stateless
+
+# Dispatcher function to hand messages from the queue to the processor pool
+# A None item is the shutdown sentinel: the dispatcher stops and waits for in-flight messages
+def message_dispatcher():
+    while True:
+        # Wait for a free worker, then for a new message to be added to the queue
+        _worker_slots.acquire()
+        item = message_queue.get()
+        if item is None:
+            _worker_slots.release()
             message_queue.task_done()
+            break
+        _dispatch_message(item)
+
+    _processor_pool.shutdown(wait=True)
 
-        except Exception as e:
-            print(f"Error processing message: {e}")
 
+# Teams already looked up by name (slug)
+_teams_by_name = {}
 
 # Function to get the team by name
 def get_team_by_name(team_name):
-    team = driver.teams.get_team_by_name(team_name)
-    return team
+    if team_name not in _teams_by_name:
+        _teams_by_name[team_name] = driver.teams.get_team_by_name(team_name)
+    return _teams_by_name[team_name]
 
 # Function to check if the bot was mentioned in the message
-def bot_is_mentioned(message, bot_username):
+def bot_is_mentioned(message, mention_re):
     # Check if the bot's username is mentioned in the message
-    return f"@{bot_username}" in message
+    return bool(mention_re.search(message))
+
+# Function to build the pattern matching an @-mention of the bot. Mattermost usernames may contain
+# letters, digits, '.', '-' and '_', so "@bot" must not match inside "@bot-dev", "@bot.dev" or "me@bot".
+def compile_mention_pattern(bot_username):
+    return re.compile(rf"(?<![\w.-])@{re.escape(bot_username)}(?![\w-]|\.[\w-])", re.IGNORECASE)
+
+# Cache of usernames by user id, least recently used first
+_usernames = OrderedDict()
+# Maximum number of usernames kept in the cache
+USERNAME_CACHE_SIZE = 1024
+# Lock guarding _usernames, which is used from the websocket and catch-up threads
+_usernames_lock = threading.Lock()
+
+# Function to add usernames to the cache, dropping the least recently used ones past the limit
+def _cache_usernames(users):
+    with _usernames_lock:
+        for user_id, username in users:
+            _usernames[user_id] = username
+            _usernames.move_to_end(user_id)
+        while len(_usernames) > USERNAME_CACHE_SIZE:
+            _usernames.popitem(last=False)
+
+# Function to resolve a user id to a username, cached per user
+def _get_username(user_id):
+    with _usernames_lock:
+        if user_id in _usernames:
+            _usernames.move_to_end(user_id)
+            return _usernames[user_id]
+    username = driver.users.get_user(user_id)["username"]
+    _cache_usernames([(user_id, username)])
+    return username
+
+# Function to fetch the usernames of several users with a single request, skipping cached ones
+def _prefetch_usernames(user_ids):
+    with _usernames_lock:
+        unknown_ids = [user_id for user_id in user_ids if user_id not in _usernames]
+    if not unknown_ids:
+        return
+    _cache_usernames((user["id"], user["username"]) for user in driver.users.get_users_by_ids(unknown_ids))
+
+# Function to decide whether the bot should answer a post. Only in-memory checks are done here,
+# so posts that are going to be ignored never cost a round-trip to the server.
+def should_answer(post, channel_type, channel_name, bot_user_id, mention_re):
+    # Ignore messages sent by the bot itself
+    if post["user_id"] == bot_user_id:
+        return False
+
+    message_text = post["message"]
+    message_time = float(post["create_at"])
+
+    # Only process messages created after the bot started
+    if message_time < boot_time:
+        log.debug("Skipping old message in channel %s: %s", channel_name, message_text)
+        return False  # Skip old messages
+
+    # Ensure we're only responding to new messages (guards against catch-up / reconnect replays)
+    if last_processed_timestamp[post["channel_id"]] >= message_time:
+        log.debug("Skipping already processed message in %s: %s", channel_name, message_text)
+        return False  # Skip already processed messages
+
+    # Check if the bot was mentioned in the message (for non-DM channels)
+    if channel_type != "D" and not bot_is_mentioned(message_text, mention_re):
+        log.debug("Bot not mentioned in %s by user %s, skipping message.", channel_name, post["user_id"])
+        return False  # Ignore messages that don't mention the bot in public channels
+
+    return True
+
+# Function to add a post the bot should answer to the processing queue
+def enqueue_post(post, channel_name):
+    message_text = post["message"]
+
+    # Get details about the user who sent the message
+    sender_username = _get_username(post["user_id"])
+
+    # Log when a new message is received and bot is mentioned
+    log.info("Received new message in %s from %s: %s", channel_name or "DM", sender_username, message_text)
 
-# Thread function to continuously pull new messages and add to the queue
+    # Add the message to the queue for processing, including the message_time
+    try:
+        message_queue.put((post["channel_id"], message_text, sender_username, float(post["create_at"])), timeout=0.1)
+    except Full:
+        log.warning("Message queue is full (backpressure); dropping message from %s in %s.", sender_username, channel_name)
+        return
+    log.debug("Message queued for processing from %s in %s.", sender_username, channel_name)
+
+# Function to filter a single post and queue it for processing if the bot should answer
+def queue_post(post, channel_type, channel_name, bot_user_id, mention_re):
+    if should_answer(post, channel_type, channel_name, bot_user_id, mention_re):
+        enqueue_post(post, channel_name)
+
+# Function to fetch posts that were sent while the websocket was not connected
+def catch_up_channels(team_id, bot_user_id, mention_re):
+    # Fetch channels the bot is part of within the specified team
+    channels = driver.channels.get_channels_for_user(team_id=team_id, user_id=bot_user_id)
+
+    # Fetch posts since the last poll time of every channel concurrently, remembering when each
+    # fetch started so the channel can later be advanced to exactly that point
+    futures = {}
+    for channel in channels:
+        # Initialize last_poll_time for the channel if it doesn't exist
+        if channel["id"] not in last_poll_time:
+            last_poll_time[channel["id"]] = boot_time
+
+        since_time = last_poll_time[channel["id"]]
+        future = _poll_pool.submit(driver.posts.get_posts_for_channel, channel["id"], params={"since": since_time})
+        futures[future] = (channel, _now_ms())
+
+    channel_posts = []
+    for future in as_completed(futures):
+        channel, fetch_time = futures[future]
+        try:
+            channel_posts.append((channel, fetch_time, future.result()))
+        except Exception as e:
+            # Leave last_poll_time alone so the next catch-up fetches this channel again
+            log.error("Error fetching posts for channel %s: %s", channel["display_name"], e)
+
+    # Filter the posts first, so only senders of posts we answer are looked up
+    to_answer = []
+    for channel, fetch_time, posts in channel_posts:
+        # Posts are ordered newest first: stop at the first one that was already processed or
+        # predates the bot's start, since every post after it is older still
+        new_posts = []
+        for post_id in posts["order"]:
+            post = posts["posts"][post_id]
+            if post["create_at"] <= last_processed_timestamp[channel["id"]] or post["create_at"] < boot_time:
+                break
+            new_posts.append(post)
+
+        # Process the new posts oldest first
+        channel_answers = [
+            post
+            for post in reversed(new_posts)
+            if should_answer(post, channel["type"], channel["display_name"], bot_user_id, mention_re)
+        ]
+        to_answer.append((channel, fetch_time, channel_answers))
+
+    # Look up every sender we are about to answer in one request. If this fails, enqueue_post
+    # still looks each sender up on its own.
+    try:
+        _prefetch_usernames({post["user_id"] for _, _, posts in to_answer for post in posts})
+    except Exception as e:
+        log.error("Error prefetching usernames: %s", e)
+
+    for channel, fetch_time, posts in to_answer:
+        try:
+            for post in posts:
+                enqueue_post(post, channel["display_name"])
+        except Exception as e:
+            # Leave last_poll_time alone so the next catch-up retries this channel
+            log.error("Error queueing posts for channel %s: %s", channel["display_name"], e)
+            continue
+
+        # Only now that the channel's posts are queued, move its poll time past them
+        last_poll_time[channel["id"]] = max(last_poll_time[channel["id"]], fetch_time)
+
+# Thread function to listen for new messages on the Mattermost websocket and add them to the queue
 def message_poller():
     driver.login()  # Log in with the bot token
-    print("Bot successfully logged in to Mattermost")
+    log.info("Bot successfully logged in to Mattermost")
 
-    bot_user_id = driver.users.get_user("me")["id"]
-    bot_username = driver.users.get_user(bot_user_id)["username"]
-    print(f"Bot user ID: {bot_user_id}, Bot username: {bot_username}")
+    me = driver.users.get_user("me")
+    bot_user_id = me["id"]
+    bot_username = me["username"]
+    log.info("Bot user ID: %s, Bot username: %s", bot_user_id, bot_username)
+    mention_re = compile_mention_pattern(bot_username)
 
     # Get the team by name (slug)
     team = get_team_by_name(TEAM_NAME)
     if not team:
-        print(f"Error: Team '{TEAM_NAME}' not found!")
+        log.error("Team '%s' not found!", TEAM_NAME)
         return
 
-    print(f"Bot is now monitoring messages in the team '{team['display_name']}'...")
+    async def event_handler(message):
+        # Stop taking on new work once shutdown has started
+        if stop_evt.is_set():
+            return
 
-    while True:
         try:
-            # Fetch channels the bot is part of within the specified team
-            channels = driver.channels.get_channels_for_user(team_id=team["id"], user_id=bot_user_id)
-
-            for channel in channels:
-                # Initialize last_poll_time for the channel if it doesn't exist
-                if channel["id"] not in last_poll_time:
-                    last_poll_time[channel["id"]] = boot_time
-
-                # Fetch posts since the last poll time by passing 'since' as a query parameter
-                since_time = last_poll_time[channel["id"]]
-                posts = driver.posts.get_posts_for_channel(channel["id"], params={"since": since_time})
-
-                # Process the posts in reverse order (latest first)
-                for post_id in reversed(posts["order"]):
-                    post = posts["posts"][post_id]
-                    # Check if the message was not sent by the bot itself
-                    if post["user_id"] != bot_user_id:
-                        message_text = post["message"]
-                        sender_user_id = post["user_id"]
-                        message_time = float(post["create_at"])
-
-                        # Only process messages created after the bot started
-                        if message_time < boot_time:
-                            if debug_messages:
-                                print(f"[DEBUG] Skipping old message in channel {channel['display_name']}: {message_text}")
-                            continue  # Skip old messages
-
-                        # Ensure we're only responding to new messages
-                        if channel["id"] in last_processed_timestamp and last_processed_timestamp[channel["id"]] >= message_time:
-                            if debug_messages:
-                                print(f"[DEBUG] Skipping already processed message in {channel['display_name']}: {message_text}")
-                            continue  # Skip already processed messages
-
-                        # Get details about the user who sent the message
-                        sender_user = driver.users.get_user(sender_user_id)
-                        sender_username = sender_user["username"]
-
-                        # Check if the bot was mentioned in the message (for non-DM channels)
-                        if channel["type"] != "D" and not bot_is_mentioned(message_text, bot_username):
-                            if debug_messages:
-                                print(f"[DEBUG] Bot not mentioned in {channel['display_name']} by {sender_username}, skipping message.")
-                            continue  # Ignore messages that don't mention the bot in public channels
-
-                        # Log when a new message is received and bot is mentioned
-                        print(f"Received new message in {channel['display_name'] or 'DM'} from {sender_username}: {message_text}")
-
-                        # Add the message to the queue for processing, including the message_time
-                        message_queue.put((channel["id"], message_text, sender_username, message_time))
-                        if debug_messages:
-                            print(f"[DEBUG] Message queued for processing from {sender_username} in {channel['display_name']}.")
-
-                # Update the last polling time for this channel after processing messages
-                last_poll_time[channel["id"]] = int(datetime.now().timestamp() * 1000)  # Current time in milliseconds
-
+            event = json.loads(message)
+            event_type = event.get("event")
+
+            # A hello event is sent on every (re)connect; pick up anything missed while disconnected.
+            # Blocking REST calls run on _ws_executor so the websocket's event loop keeps
+            # servicing pings while they are in flight.
+            loop = asyncio.get_running_loop()
+            if event_type == "hello":
+                await loop.run_in_executor(_ws_executor, catch_up_channels, team["id"], bot_user_id, mention_re)
+                return
+
+            if event_type != "posted":
+                return
+
+            data = event["data"]
+            # Direct and group messages have no team; everything else must belong to our team
+            if data.get("team_id") not in ("", team["id"]):
+                return
+
+            post = json.loads(data["post"])
+            last_poll_time[post["channel_id"]] = max(last_poll_time.get(post["channel_id"], boot_time), post["create_at"])
+            await loop.run_in_executor(_ws_executor, queue_post, post, data["channel_type"], data.get("channel_display_name", ""), bot_user_id, mention_re)
         except Exception as e:
-            print(f"Error while polling messages: {e}")
+            log.error("Error while handling websocket event: %s", e)
+
+    log.info("Bot is now monitoring messages in the team '%s'...", team["display_name"])
 
-        # Poll every half second
-        time.sleep(1)
+    # The driver runs the websocket on the current thread's event loop
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    driver.init_websocket(event_handler)
+
+# Signal handler asking the bot to shut down
+def _shutdown(signum, frame):
+    log.info("Received signal %s. Shutting down gracefully...", signum)
+    stop_evt.set()
 
 def main():
     # Start the message poller thread
     poller_thread = threading.Thread(target=message_poller, daemon=True)
     poller_thread.start()
 
-    # Start the message processor thread to handle messages from the queue
-    processor_thread = threading.Thread(target=message_processor, daemon=True)
-    processor_thread.start()
+    # Start the dispatcher thread to hand messages from the queue to the processor pool
+    dispatcher_thread = threading.Thread(target=message_dispatcher, daemon=True)
+    dispatcher_thread.start()
+
+    # Shut down gracefully on SIGTERM (e.g. from a service manager) as well as on Ctrl+C
+    signal.signal(signal.SIGTERM, _shutdown)
 
-    # Keep the main thread alive to prevent program exit
+    # Keep the main thread alive until shutdown is requested
     try:
-        while True:
-            time.sleep(1)
+        while not stop_evt.is_set():
+            stop_evt.wait(1)
     except KeyboardInterrupt:
-        print("\nReceived KeyboardInterrupt. Shutting down gracefully...")
-        # The daemon threads will automatically terminate when the main thread exits
-        # We can add any cleanup code here if needed
-        print("Shutdown complete.")
+        log.info("Received KeyboardInterrupt. Shutting down gracefully...")
+        stop_evt.set()
+
+    # Stop listening for new posts, then let the dispatcher hand out what is already queued and
+    # wait for the answers in progress
+    if driver.websocket:
+        driver.websocket.disconnect()
+    message_queue.put(None)
+    dispatcher_thread.join()
+    log.info("Shutdown complete.")
 
 if __name__ == "__main__":
     main()